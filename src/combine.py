@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 # coding=utf-8
-__version__ = "2.5.0"
+__version__ = "2.6.0"
 # When modifying remember to issue a new tag command in git before committing, then push the new tag
-#   git tag -a v2.5.0 -m "v2.5.0"
+#   git tag -a v2.6.0 -m "v2.6.0"
 #   git push origin --tags
 """
 Python script that generates the necessary mp4box -cat commands to concatinate multiple video files 
@@ -37,6 +37,9 @@ import re # To perform substring matching on the output of mp4box and other subp
 from datetime import timedelta # To store the parsed duration of files and calculate the accumulated duration
 from random import shuffle # To be able to shuffle the list of files if the user requests it
 import csv # To use for the cutpoint files they are CSV files
+import tempfile # To create the private working directory inside the scratch directory
+import shutil # To check available disk space and to move/remove files across volumes
+import errno # To detect when a rename fails because the source and destination are on different volumes
 #
 # Provides natural string sorting (numbers inside strings are sorted in the correct order)
 # http://stackoverflow.com/a/3033342/779521
@@ -73,17 +76,22 @@ def runMain():
     # Detect the maximum file size that should be generated in kilobytes, if <=0 then unlimited
     max_out_size_kb = determineMaximumOutputfileSizeInKb(args.size, args.disk)
 
-    # Create the output file names both for the video file and the intermediate chapters file
+    # Create the output file name for the video file, intermediate files are created in the scratch directory
     path_out_file = Path(args.output)
-    path_chapters_file = path_out_file.with_suffix('.txt') # Just change the file-extension of the output file to TXT
 
-    # If the output files exist then either error or overwrite
-    if( path_out_file.exists() ):
-      if( args.overwrite ):
-        os.remove(str(path_out_file))
-      else:
-        print( "Output file '{0}' already exists. Use --overwrite switch to overwrite.".format(Colors.filename(path_out_file.name)))
-        sys.exit(0)
+    # Make sure that the output directory exists
+    path_out_file.parent.mkdir(parents=True, exist_ok=True)
+
+    # The scratch directory holds all intermediate files, defaults to the output directory
+    path_scratch_dir = Path(args.scratch_dir) if args.scratch_dir else path_out_file.parent
+    path_scratch_dir.mkdir(parents=True, exist_ok=True)
+
+    # If the output files (or split parts from an earlier run) exist then error unless asked to overwrite,
+    # when overwriting the existing files are only replaced once the new ones are complete
+    existing_out_files = getExistingOutputFiles(path_out_file)
+    if( len(existing_out_files) > 0 and not args.overwrite ):
+      print( "Output file '{0}' already exists. Use --overwrite switch to overwrite.".format(Colors.filename(existing_out_files[0].name)))
+      sys.exit(0)
 
     # Get all the input files
     in_files = getFileNamesFromGrepMatch(args.match, path_out_file)
@@ -138,8 +146,17 @@ def runMain():
       chapters.append({"name": Path(file_info['file']).stem, "timecode":formatTimedelta(cumulative_dur)})
       cumulative_dur += file_info_dur # Count the cumulative duration
       cumulative_size += file_info['size'] 
+
+    # Warn if the scratch and output locations look too small to hold the result before spending time on encoding
+    for space_warning in checkAvailableDiskSpace(cumulative_size, max_out_size_kb, path_scratch_dir, path_out_file.parent):
+      print(Colors.error(space_warning))
      
-    createCombinedVideoFile(video_files, chapters, cumulative_dur, cumulative_size, mp4exec, ffmpegexec, path_out_file, path_chapters_file, args.overwrite, cuts, args.videosize, args.burnsubs, max_out_size_kb, args.noaudio )
+    out_files = createCombinedVideoFile(video_files, chapters, cumulative_dur, cumulative_size, mp4exec, ffmpegexec, path_out_file, path_scratch_dir, args.overwrite, cuts, args.videosize, args.burnsubs, max_out_size_kb, args.noaudio )
+
+    # Remove any output files from an earlier run that were not replaced by this one (e.g. surplus split parts)
+    for existing_out_file in existing_out_files:
+      if not existing_out_file in out_files and existing_out_file.exists():
+        os.remove(str(existing_out_file))
     
     print(Colors.success("Script completed successfully, bye!"))
   finally:
@@ -172,38 +189,129 @@ def parseCutPointInformation(path_to_cuts_file):
 
 #
 # Creates a combined video file for a segment
-def createCombinedVideoFile(video_files, chapters, cumulative_dur, cumulative_size, mp4exec, ffmpegexec, path_out_file, path_chapters_file, args_overwrite, cuts, args_videomaxsize, args_burnsubs, max_out_size_kb=0, args_noaudio=False ):
+# All intermediate files are created in a private working directory under the scratch directory and
+# the finished video files are only moved onto the output location once they are complete
+# Returns the list of video files created in the output location
+def createCombinedVideoFile(video_files, chapters, cumulative_dur, cumulative_size, mp4exec, ffmpegexec, path_out_file, path_scratch_dir, args_overwrite, cuts, args_videomaxsize, args_burnsubs, max_out_size_kb=0, args_noaudio=False ):
 
   print( "Output: {0}".format(Colors.fileout(str(path_out_file))))
-  
-  # Add the final chapter as the end for this segment
-  chapters.append({"name": "End", "timecode":formatTimedelta(cumulative_dur)})
 
-  # Chapters should be +1 more than files as we have an extra chapter ending at the very end of the file
-  print("{0} chapters, {1} running time, {2} total size".format( len(chapters), formatTimedelta(cumulative_dur), humanize.naturalsize(cumulative_size, gnu=True)))
+  # Create the working directory and the intermediate file names for the video file and the chapters file
+  path_work_dir = Path(tempfile.mkdtemp(prefix="mp4combine_", dir=str(path_scratch_dir)))
+  path_work_file = path_work_dir / path_out_file.name
+  path_chapters_file = path_work_file.with_suffix('.txt') # Just change the file-extension of the output file to TXT
+  print( "Scratch: {0}".format(Colors.filename(str(path_work_dir))))
 
-  # Write the chapters file to out
-  saveChaptersFile(chapters, path_chapters_file)
+  try:
+    # Add the final chapter as the end for this segment
+    chapters.append({"name": "End", "timecode":formatTimedelta(cumulative_dur)})
 
-  # Re-encode and combine the video files first
-  print(Colors.toolpath("Combining and re-encoding video files (ffmpeg), this will take a while..."))
-  reencodeAndCombineVideoFiles(ffmpegexec, video_files, path_out_file, args_videomaxsize, cuts, args_burnsubs, args_noaudio)
-  
-  # Now create the combined file and include the chapter marks
-  print(Colors.toolpath("Adding chapters to combined video file (mp4box)"))
-  addChaptersToVideoFile(mp4exec, path_out_file, path_chapters_file)
+    # Chapters should be +1 more than files as we have an extra chapter ending at the very end of the file
+    print("{0} chapters, {1} running time, {2} total size".format( len(chapters), formatTimedelta(cumulative_dur), humanize.naturalsize(cumulative_size, gnu=True)))
+
+    # Write the chapters file to the working directory
+    saveChaptersFile(chapters, path_chapters_file)
 
-  # Delete the chapters file
-  os.remove(str(path_chapters_file))
+    # Re-encode and combine the video files first
+    print(Colors.toolpath("Combining and re-encoding video files (ffmpeg), this will take a while..."))
+    reencodeAndCombineVideoFiles(ffmpegexec, video_files, path_work_file, args_videomaxsize, cuts, args_burnsubs, args_noaudio)
+    
+    # Now create the combined file and include the chapter marks
+    print(Colors.toolpath("Adding chapters to combined video file (mp4box)"))
+    addChaptersToVideoFile(mp4exec, path_work_file, path_chapters_file, path_work_dir)
 
-  # Read the created file to learn its final filesize
-  size_out_file_kb = os.path.getsize(str(path_out_file)) / 1024
-  print( Colors.toolpath("Final size of video file is: {0}".format(humanize.naturalsize(size_out_file_kb * 1024))))
+    # Delete the chapters file
+    os.remove(str(path_chapters_file))
 
-  # Now split the file if requested
-  if max_out_size_kb > 0 and size_out_file_kb > max_out_size_kb :
-    print( Colors.toolpath("Size limit exceeded, splitting video into files of max size: {0}".format(humanize.naturalsize(max_out_size_kb * 1000))))
-    splitVideoFile(mp4exec, path_out_file, max_out_size_kb)
+    # Read the created file to learn its final filesize
+    size_out_file_kb = os.path.getsize(str(path_work_file)) / 1024
+    print( Colors.toolpath("Final size of video file is: {0}".format(humanize.naturalsize(size_out_file_kb * 1024))))
+
+    # Now split the file if requested
+    if max_out_size_kb > 0 and size_out_file_kb > max_out_size_kb :
+      print( Colors.toolpath("Size limit exceeded, splitting video into files of max size: {0}".format(humanize.naturalsize(max_out_size_kb * 1000))))
+      splitVideoFile(mp4exec, path_work_file, max_out_size_kb, path_work_dir)
+
+    # Finally move the combined file (and any split parts) onto the output location
+    # the working directory is private to this run so every video file in it is ours
+    work_files = sorted([p for p in path_work_dir.iterdir() if p.is_file() and p.suffix == path_work_file.suffix], key=lambda p: natural_key(p.name))
+    if len(work_files) <= 0:
+      raise ValueError("No finished video files were found in {0}, nothing was moved to the output location.".format(path_work_dir))
+
+    print(Colors.toolpath("Moving video files to output location"))
+    out_files = []
+    for work_file in work_files:
+      path_dest_file = path_out_file.parent / work_file.name
+      moveFileAtomically(work_file, path_dest_file)
+      out_files.append(path_dest_file)
+      print( " {0}".format(Colors.fileout(str(path_dest_file))))
+    return out_files
+  finally:
+    # Never leave intermediate files behind in the scratch directory
+    shutil.rmtree(str(path_work_dir), ignore_errors=True)
+
+#
+# Returns the existing output file and any split parts of it (<stem>_001.mp4, ...) in the output directory
+def getExistingOutputFiles(path_out_file):
+  existing_files = [path_out_file] if path_out_file.exists() else []
+  existing_files += sorted(path_out_file.parent.glob(glob.escape(path_out_file.stem) + "_[0-9]*" + path_out_file.suffix), key=lambda p: natural_key(p.name))
+  return existing_files
+
+#
+# Checks that the scratch and output locations have enough free space to hold the combined video.
+# The size of the combined video is estimated from the total size of the input files, this usually 
+# overestimates it as the video is re-encoded, downscaled and possibly cut. While mp4box adds the chapters
+# it rewrites the file in the scratch directory and while splitting the split parts live next to the 
+# combined file, so room for two copies is needed there.
+# Returns a list of warning messages for the locations that appear to lack the space, empty if all is well
+def checkAvailableDiskSpace(predicted_size, max_out_size_kb, path_scratch_dir, path_out_dir):
+  scratch_size = predicted_size * 2
+  out_size = predicted_size * 2 if max_out_size_kb > 0 else predicted_size
+
+  # If both are on the same volume the final move is a simple rename and needs no extra space
+  required_space = [(path_scratch_dir, scratch_size)]
+  if os.stat(str(path_scratch_dir)).st_dev != os.stat(str(path_out_dir)).st_dev:
+    required_space.append((path_out_dir, out_size))
+
+  warnings = []
+  for path_dir, required in required_space:
+    free_size = shutil.disk_usage(str(path_dir)).free
+    if free_size < required:
+      warnings.append("Warning: '{0}' may not have enough free space, {1} estimated from the size of the input files but only {2} available. "
+                      "The re-encoded output is usually smaller than its inputs so the script will continue.".format(path_dir, humanize.naturalsize(required, gnu=True), humanize.naturalsize(free_size, gnu=True)))
+  return warnings
+
+#
+# Moves a finished file onto its destination so that a partially written file is never visible there.
+# Within the same volume this is a simple rename, across volumes the file is first copied to a hidden 
+# temporary name next to the destination, flushed to disk and then renamed onto it
+def moveFileAtomically(path_src_file, path_dest_file):
+  try:
+    os.replace(str(path_src_file), str(path_dest_file))
+    return
+  except OSError as e:
+    if e.errno != errno.EXDEV:
+      raise
+
+  path_partial_file = path_dest_file.with_name("." + path_dest_file.name + ".partial")
+  try:
+    shutil.copyfile(str(path_src_file), str(path_partial_file))
+    with path_partial_file.open(mode='rb+') as partial_file:
+      os.fsync(partial_file.fileno())
+    os.replace(str(path_partial_file), str(path_dest_file))
+  except BaseException:
+    if path_partial_file.exists():
+      os.remove(str(path_partial_file))
+    raise
+
+  # Flush the directory entry as well so the rename survives a crash (not supported on Windows)
+  if hasattr(os, 'O_DIRECTORY'):
+    dir_fd = os.open(str(path_dest_file.parent), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+      os.fsync(dir_fd)
+    finally:
+      os.close(dir_fd)
+  os.remove(str(path_src_file))
 
 #
 # Attempts to detect the requested size of the output file based on the input parameters
@@ -443,7 +551,7 @@ def reencodeAndCombineVideoFiles(ffmpeg_path, video_files, path_out_file, args_v
 
 #
 # Calls mp4box to create the concatinated video file and includes the chapter file as well
-def addChaptersToVideoFile(mp4box_path, path_video_file, path_chapters_file):
+def addChaptersToVideoFile(mp4box_path, path_video_file, path_chapters_file, path_tmp_dir):
 
   # Check to see if the video file exists before doing anything
   if not path_video_file.exists():
@@ -452,10 +560,10 @@ def addChaptersToVideoFile(mp4box_path, path_video_file, path_chapters_file):
   # Construct the args to mp4box
   prog_args = [mp4box_path]
 
-  # Overwrite the default temporary folder to somewhere we
-  # know that the current user has write privileges
+  # Overwrite the default temporary folder to the scratch working
+  # directory where we know that the current user has write privileges
   prog_args.append("-tmp")
-  prog_args.append("{0}".format(os.environ['TMP']))
+  prog_args.append(str(path_tmp_dir))
 
   # Add the chapter file
   prog_args.append("-add")
@@ -470,7 +578,7 @@ def addChaptersToVideoFile(mp4box_path, path_video_file, path_chapters_file):
 
 #
 # Splits an existing video file into requested chunks
-def splitVideoFile(mp4box_path, path_video_file, max_out_size_kb):
+def splitVideoFile(mp4box_path, path_video_file, max_out_size_kb, path_tmp_dir):
   
   # Can't split something that doesn't exist
   if not path_video_file.exists():
@@ -483,10 +591,10 @@ def splitVideoFile(mp4box_path, path_video_file, max_out_size_kb):
   prog_args.append("-splits")
   prog_args.append(str(max_out_size_kb))
 
-  # Overwrite the default temporary folder to somewhere we
-  # know that the current user has write privileges
+  # Overwrite the default temporary folder to the scratch working
+  # directory where we know that the current user has write privileges
   prog_args.append("-tmp")
-  prog_args.append("{0}".format(os.environ['TMP']))
+  prog_args.append(str(path_tmp_dir))
 
   # Add the input file we want to split
   prog_args.append(str(path_video_file))
@@ -603,6 +711,9 @@ def parseArguments():
   parser.add_argument("-d", "--debug",  help="Prints out extra debugging information while script is running", 
                                         action="store_true")
 
+  parser.add_argument("--scratch-dir", help="Directory for intermediate files (re-encoded video, chapter file and mp4box temporary data), e.g. a fast local disk. Defaults to the output directory. Finished files are moved to the output location once complete.", 
+                                        type=str)
+
   parser.add_argument("--noaudio",  help="Explicitly disables audio tracks in the output video (useful for source videos that have no audio track)", 
                                     action="store_true")
 